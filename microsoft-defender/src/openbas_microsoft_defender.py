@@ -18,6 +18,8 @@ from pyobas.helpers import (
     OpenBASDetectionHelper,
 )
 
+PREVENTION_STATUSES = frozenset(["prevented", "remediated", "blocked"])
+
 
 class OpenBASMicrosoftDefender:
     def __init__(self):
@@ -73,6 +75,15 @@ class OpenBASMicrosoftDefender:
             security_platform_type="EDR",
         )
 
+        # Auth (the credential caches its token across runs)
+        scopes = ["https://graph.microsoft.com/.default"]
+        credential = ClientSecretCredential(
+            tenant_id=self.config.get_conf("microsoft_defender_tenant_id"),
+            client_id=self.config.get_conf("microsoft_defender_client_id"),
+            client_secret=self.config.get_conf("microsoft_defender_client_secret"),
+        )
+        self.graph_client = GraphServiceClient(credential, scopes=scopes)  # type: ignore
+
         # Initialize signatures helper
         # TODO Command line
         # self.relevant_signatures_types = ["process_name", "command_line", "file_name", "hostname", "ipv4_address"]
@@ -103,11 +114,11 @@ class OpenBASMicrosoftDefender:
         return process_names
 
     def _extract_command_lines(self, alert):
-        command_lines = []
-        for evidence in alert.evidence:
-            if evidence.odata_type == "#microsoft.graph.security.processEvidence":
-                command_lines.append(evidence.process_command_line)
-        return command_lines
+        return [
+            evidence.process_command_line
+            for evidence in alert.evidence
+            if evidence.odata_type == "#microsoft.graph.security.processEvidence"
+        ]
 
     def _extract_hostnames(self, alert):
         hostnames = []
@@ -118,90 +129,62 @@ class OpenBASMicrosoftDefender:
         return hostnames
 
     def _extract_file_names(self, alert):
-        file_names = []
-        for evidence in alert.evidence:
-            if evidence.odata_type == "#microsoft.graph.security.fileEvidence":
-                file_names.append(evidence.file_details.file_name)
-        return file_names
+        return [
+            evidence.file_details.file_name
+            for evidence in alert.evidence
+            if evidence.odata_type == "#microsoft.graph.security.fileEvidence"
+        ]
 
     def _extract_ip_addresses(self, alert):
-        ip_addresses = []
-        for evidence in alert.evidence:
-            if evidence.odata_type == "#microsoft.graph.security.ipEvidence":
-                ip_addresses.append(evidence.ip_address)
-        return ip_addresses
+        return [
+            evidence.ip_address
+            for evidence in alert.evidence
+            if evidence.odata_type == "#microsoft.graph.security.ipEvidence"
+        ]
 
     def _is_prevented(self, alert):
         for evidence in alert.evidence:
             if evidence.odata_type == "#microsoft.graph.security.processEvidence":
-                if evidence.detection_status in [
-                    "prevented",
-                    "remediated",
-                    "blocked",
-                ]:
+                if evidence.detection_status in PREVENTION_STATUSES:
                     return True
         return False
 
-    def _match_alert(self, endpoint, alert, expectation):
+    def _build_alert_data(self, alert):
+        ip_addresses = self._extract_ip_addresses(alert)
+        return {
+            "process_name": {
+                "type": "fuzzy",
+                "data": self._extract_process_names(alert),
+                "score": 80,
+            },
+            "file_name": {
+                "type": "fuzzy",
+                "data": self._extract_file_names(alert),
+                "score": 80,
+            },
+            "hostname": {
+                "type": "fuzzy",
+                "data": self._extract_hostnames(alert),
+                "score": 80,
+            },
+            "ipv4_address": {"type": "fuzzy", "data": ip_addresses, "score": 80},
+            "ipv6_address": {"type": "fuzzy", "data": ip_addresses, "score": 80},
+        }
+
+    def _match_alert(self, endpoint, alert, alert_data, expectation):
+        # No asset
+        if expectation["inject_expectation_asset"] is None:
+            return False
+
         self.helper.collector_logger.info(
             "Trying to match alert "
             + str(alert.id)
             + " with expectation "
             + expectation["inject_expectation_id"]
         )
-
-        # No asset
-        if expectation["inject_expectation_asset"] is None:
-            return False
-
-        # Check hostname
-        hostname = self._extract_device(alert)
-        if hostname is None or hostname != endpoint["endpoint_hostname"]:
-            return False
         self.helper.collector_logger.info(
             "Endpoint is matching (" + endpoint["endpoint_hostname"] + ")"
         )
-
-        alert_data = {}
-        for type in self.relevant_signatures_types:
-            alert_data[type] = {}
-            if type == "process_name":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_process_names(alert),
-                    "score": 80,
-                }
-            elif type == "command_line":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_command_lines(alert),
-                    "score": 60,
-                }
-                alert_data[type]["fuzzy"] = 60
-            elif type == "file_name":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_file_names(alert),
-                    "score": 80,
-                }
-            elif type == "hostname":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_hostnames(alert),
-                    "score": 80,
-                }
-            elif type == "ipv4_address":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_ip_addresses(alert),
-                    "score": 80,
-                }
-            elif type == "ipv6_address":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_ip_addresses(alert),
-                    "score": 80,
-                }
         match_result = self.openbas_detection_helper.match_alert_elements(
             signatures=expectation["inject_expectation_signatures"],
             alert_data=alert_data,
@@ -214,10 +197,11 @@ class OpenBASMicrosoftDefender:
         return False
 
     async def _process_alerts(self, graph_client):
+        collector_id = self.config.get_conf("collector_id")
         self.helper.collector_logger.info("Gathering expectations for executed injects")
         expectations = (
             self.helper.api.inject_expectation.expectations_assets_for_source(
-                self.config.get_conf("collector_id")
+                collector_id
             )
         )
         self.helper.collector_logger.info(
@@ -234,6 +218,24 @@ class OpenBASMicrosoftDefender:
             request_configuration=request_configuration
         )
         self.helper.collector_logger.info("Found " + str(len(alerts.value)) + " alerts")
+        # Only recent alerts can fulfill an expectation, filter them once
+        recent_alerts = [
+            alert
+            for alert in alerts.value
+            if parse(str(alert.created_date_time)).astimezone(pytz.UTC) > limit_date
+        ]
+        # Index alerts by device so each endpoint only sees its own alerts
+        alerts_by_hostname = {}
+        for alert in recent_alerts:
+            hostname = self._extract_device(alert)
+            if hostname is None:
+                continue
+            alerts_by_hostname.setdefault(hostname, []).append(alert)
+        # Alert data does not depend on the expectation, build it once per
+        # alert and only for alerts on a targeted endpoint
+        alerts_data = {}
+        # Endpoints are shared by expectations, fetch each one once per run
+        endpoints = {}
         # For each expectation, try to find the proper alert
         for expectation in expectations:
             # Check expired expectation
@@ -251,7 +253,7 @@ class OpenBASMicrosoftDefender:
                 self.helper.api.inject_expectation.update(
                     expectation["inject_expectation_id"],
                     {
-                        "collector_id": self.config.get_conf("collector_id"),
+                        "collector_id": collector_id,
                         "result": (
                             "Not Detected"
                             if expectation["inject_expectation_type"] == "DETECTION"
@@ -261,61 +263,52 @@ class OpenBASMicrosoftDefender:
                     },
                 )
                 continue
-            endpoint = self.helper.api.endpoint.get(
-                expectation["inject_expectation_asset"]
-            )
-            for i in range(len(alerts.value)):
-                alert = alerts.value[i]
-                alert_date = parse(str(alert.created_date_time)).astimezone(pytz.UTC)
-                if alert_date > limit_date:
-                    result = self._match_alert(endpoint, alert, expectation)
-                    if result is not False:
-                        self.helper.collector_logger.info(
-                            "Expectation matched, fulfilling expectation "
-                            + expectation["inject_expectation_inject"]
-                            + " ("
-                            + expectation["inject_expectation_type"]
-                            + ")"
+            asset_id = expectation["inject_expectation_asset"]
+            if asset_id not in endpoints:
+                endpoints[asset_id] = self.helper.api.endpoint.get(asset_id)
+            endpoint = endpoints[asset_id]
+            for alert in alerts_by_hostname.get(endpoint["endpoint_hostname"], []):
+                if alert.id not in alerts_data:
+                    alerts_data[alert.id] = self._build_alert_data(alert)
+                result = self._match_alert(
+                    endpoint, alert, alerts_data[alert.id], expectation
+                )
+                if result is not False:
+                    self.helper.collector_logger.info(
+                        "Expectation matched, fulfilling expectation "
+                        + expectation["inject_expectation_inject"]
+                        + " ("
+                        + expectation["inject_expectation_type"]
+                        + ")"
+                    )
+                    if expectation["inject_expectation_type"] == "DETECTION":
+                        self.helper.api.inject_expectation.update(
+                            expectation["inject_expectation_id"],
+                            {
+                                "collector_id": collector_id,
+                                "result": "Detected",
+                                "is_success": True,
+                            },
+                        )
+                        break
+                    elif (
+                        expectation["inject_expectation_type"] == "PREVENTION"
+                        and result == "PREVENTED"
+                    ):
+                        self.helper.api.inject_expectation.update(
+                            expectation["inject_expectation_id"],
+                            {
+                                "collector_id": collector_id,
+                                "result": "Prevented",
+                                "is_success": True,
+                            },
                         )
-                        if expectation["inject_expectation_type"] == "DETECTION":
-                            self.helper.api.inject_expectation.update(
-                                expectation["inject_expectation_id"],
-                                {
-                                    "collector_id": self.config.get_conf(
-                                        "collector_id"
-                                    ),
-                                    "result": "Detected",
-                                    "is_success": True,
-                                },
-                            )
-                        elif (
-                            expectation["inject_expectation_type"] == "PREVENTION"
-                            and result == "PREVENTED"
-                        ):
-                            self.helper.api.inject_expectation.update(
-                                expectation["inject_expectation_id"],
-                                {
-                                    "collector_id": self.config.get_conf(
-                                        "collector_id"
-                                    ),
-                                    "result": "Prevented",
-                                    "is_success": True,
-                                },
-                            )
+                        break
 
     def _process_message(self) -> None:
-        # Auth
-        scopes = ["https://graph.microsoft.com/.default"]
-        credential = ClientSecretCredential(
-            tenant_id=self.config.get_conf("microsoft_defender_tenant_id"),
-            client_id=self.config.get_conf("microsoft_defender_client_id"),
-            client_secret=self.config.get_conf("microsoft_defender_client_secret"),
-        )
-        graph_client = GraphServiceClient(credential, scopes=scopes)  # type: ignore
-
         # Execute
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(self._process_alerts(graph_client))
+        loop.run_until_complete(self._process_alerts(self.graph_client))
 
     # Start the main loop
     def start(self):
@@ -11,7 +11,14 @@ from pyobas.helpers import (
     OpenBASConfigHelper,
     OpenBASDetectionHelper,
 )
-from sentinel_api_handler import SentinelApiHandler
+from sentinel_api_handler import LOG_ANALYTICS_URL, SentinelApiHandler
+
+SECURITY_ALERTS_QUERY = (
+    "SecurityAlert | sort by TimeGenerated desc | take 200"
+    " | project SystemAlertId, TimeGenerated, Entities, ExtendedProperties"
+)
+
+PREVENTION_ACTIONS = frozenset(["blocked", "quarantine", "remove"])
 
 
 class OpenBASMicrosoftSentinel:
@@ -81,7 +88,12 @@ class OpenBASMicrosoftSentinel:
             security_platform_type="SIEM",
         )
 
-        self.log_analytics_url = "https://api.loganalytics.azure.com/v1"
+        self.query_url = (
+            LOG_ANALYTICS_URL
+            + "/workspaces/"
+            + self.config.get_conf("microsoft_sentinel_workspace_id")
+            + "/query"
+        )
 
         # Initialize Sentinel API
         self.sentinel_api_handler = SentinelApiHandler(
@@ -104,16 +116,14 @@ class OpenBASMicrosoftSentinel:
             self.helper.collector_logger, self.relevant_signatures_types
         )
 
-    def _extract_device(self, columns_index, alert):
-        entities = json.loads(alert[columns_index["Entities"]])
+    def _extract_device(self, entities):
         for entity in entities:
             if "Type" in entity and entity["Type"] == "host":
                 return entity["HostName"]
         return None
 
-    def _extract_process_names(self, columns_index, alert):
+    def _extract_process_names(self, entities):
         process_names = []
-        entities = json.loads(alert[columns_index["Entities"]])
         for entity in entities:
             if "Type" in entity and entity["Type"] == "process":
                 if "ImageFile" in entity and "Name" in entity["ImageFile"]:
@@ -122,28 +132,15 @@ class OpenBASMicrosoftSentinel:
                 process_names.append(entity["Name"])
         return process_names
 
-    def _extract_command_lines(self, columns_index, alert):
-        command_lines = []
-        entities = json.loads(alert[columns_index["Entities"]])
-        for entity in entities:
-            if "Type" in entity and entity["Type"] == "process":
-                command_lines.append(entity["CommandLine"])
-        return command_lines
-
-    def _extract_file_names(self, columns_index, alert):
-        file_names = []
-        entities = json.loads(alert[columns_index["Entities"]])
-        for entity in entities:
-            if "Type" in entity and entity["Type"] == "process":
-                if "ImageFile" in entity and "Name" in entity["ImageFile"]:
-                    file_names.append(entity["ImageFile"]["Name"])
-            elif "Type" in entity and entity["Type"] == "file":
-                file_names.append(entity["Name"])
-        return file_names
+    def _extract_command_lines(self, entities):
+        return [
+            entity["CommandLine"]
+            for entity in entities
+            if "Type" in entity and entity["Type"] == "process"
+        ]
 
-    def _extract_hostnames(self, columns_index, alert):
+    def _extract_hostnames(self, entities):
         hostnames = []
-        entities = json.loads(alert[columns_index["Entities"]])
         for entity in entities:
             if "Type" in entity and entity["Type"] == "dns":
                 hostnames.append(entity["DomainName"])
@@ -152,82 +149,52 @@ class OpenBASMicrosoftSentinel:
                 hostnames.append(parsed_url.netloc)
         return hostnames
 
-    def _extract_ip_addresses(self, columns_index, alert):
-        ip_addresses = []
-        entities = json.loads(alert[columns_index["Entities"]])
-        for entity in entities:
-            if "Type" in entity and entity["Type"] == "ip":
-                ip_addresses.append(entity["Address"])
-        return ip_addresses
+    def _extract_ip_addresses(self, entities):
+        return [
+            entity["Address"]
+            for entity in entities
+            if "Type" in entity and entity["Type"] == "ip"
+        ]
 
     def _is_prevented(self, columns_index, alert):
         extended_properties = json.loads(alert[columns_index["ExtendedProperties"]])
-        if "Action" in extended_properties and extended_properties["Action"] in [
-            "blocked",
-            "quarantine",
-            "remove",
-        ]:
-            return True
-        return False
+        action = extended_properties.get("Action")
+        return isinstance(action, str) and action in PREVENTION_ACTIONS
 
-    def _match_alert(self, endpoint, columns_index, alert, expectation):
-        print(alert)
+    def _build_alert_data(self, entities):
+        # file_name relies on the same image names as process_name
+        process_names = self._extract_process_names(entities)
+        ip_addresses = self._extract_ip_addresses(entities)
+        return {
+            "process_name": {"type": "fuzzy", "data": process_names, "score": 80},
+            "command_line": {
+                "type": "fuzzy",
+                "data": self._extract_command_lines(entities),
+                "score": 60,
+            },
+            "file_name": {"type": "fuzzy", "data": process_names, "score": 80},
+            "hostname": {
+                "type": "fuzzy",
+                "data": self._extract_hostnames(entities),
+                "score": 80,
+            },
+            "ipv4_address": {"type": "fuzzy", "data": ip_addresses, "score": 80},
+            "ipv6_address": {"type": "fuzzy", "data": ip_addresses, "score": 80},
+        }
+
+    def _match_alert(self, endpoint, columns_index, alert, alert_data, expectation):
+        # No asset
+        if expectation["inject_expectation_asset"] is None:
+            return False
         self.helper.collector_logger.info(
             "Trying to match alert "
             + str(alert[columns_index["SystemAlertId"]])
             + " with expectation "
             + expectation["inject_expectation_id"]
         )
-        # No asset
-        if expectation["inject_expectation_asset"] is None:
-            return False
-        # Check hostname
-        hostname = self._extract_device(columns_index, alert)
-        if hostname is None or hostname != endpoint["endpoint_hostname"]:
-            return False
         self.helper.collector_logger.info(
             "Endpoint is matching (" + endpoint["endpoint_hostname"] + ")"
         )
-
-        alert_data = {}
-        for type in self.relevant_signatures_types:
-            alert_data[type] = {}
-            if type == "process_name":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_process_names(columns_index, alert),
-                    "score": 80,
-                }
-            elif type == "command_line":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_command_lines(columns_index, alert),
-                    "score": 60,
-                }
-            elif type == "file_name":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_file_names(columns_index, alert),
-                    "score": 80,
-                }
-            elif type == "hostname":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_hostnames(columns_index, alert),
-                    "score": 80,
-                }
-            elif type == "ipv4_address":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_ip_addresses(columns_index, alert),
-                    "score": 80,
-                }
-            elif type == "ipv6_address":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_ip_addresses(columns_index, alert),
-                    "score": 80,
-                }
         match_result = self.openbas_detection_helper.match_alert_elements(
             signatures=expectation["inject_expectation_signatures"],
             alert_data=alert_data,
@@ -240,35 +207,56 @@ class OpenBASMicrosoftSentinel:
         return False
 
     def _process_alerts(self):
+        collector_id = self.config.get_conf("collector_id")
         self.helper.collector_logger.info("Gathering expectations for executed injects")
         expectations = (
             self.helper.api.inject_expectation.expectations_assets_for_source(
-                self.config.get_conf("collector_id")
+                collector_id
             )
         )
         self.helper.collector_logger.info(
             "Found " + str(len(expectations)) + " expectations waiting to be matched"
         )
+        if len(expectations) == 0:
+            return
         limit_date = datetime.now().astimezone(pytz.UTC) - relativedelta(minutes=45)
 
         # Retrieve alerts
-        url = (
-            self.log_analytics_url
-            + "/workspaces/"
-            + self.config.get_conf("microsoft_sentinel_workspace_id")
-            + "/query"
+        body = {"query": SECURITY_ALERTS_QUERY}
+        data = self.sentinel_api_handler._query(
+            method="post", url=self.query_url, payload=body
         )
-        body = {"query": "SecurityAlert | sort by TimeGenerated desc | take 200"}
-        data = self.sentinel_api_handler._query(method="post", url=url, payload=body)
-        if len(data["tables"]) == 0:
+        if len(data["tables"]) == 0 or len(data["tables"][0]["rows"]) == 0:
             return
         self.helper.collector_logger.info(
             "Found " + str(len(data["tables"][0]["rows"])) + " alerts"
         )
         columns = data["tables"][0]["columns"]
-        columns_index = {}
-        for idx, column in enumerate(columns):
-            columns_index[column["name"]] = idx
+        columns_index = {column["name"]: idx for idx, column in enumerate(columns)}
+        # Only recent alerts can fulfill an expectation, filter them once
+        alerts = [
+            alert
+            for alert in data["tables"][0]["rows"]
+            if parse(str(alert[columns_index["TimeGenerated"]])).astimezone(pytz.UTC)
+            > limit_date
+        ]
+        # Index alerts by device so each endpoint only sees its own alerts
+        alerts_by_hostname = {}
+        for index, alert in enumerate(alerts):
+            raw_entities = alert[columns_index["Entities"]]
+            # No entities, nothing to match against
+            if not raw_entities:
+                continue
+            entities = json.loads(raw_entities)
+            hostname = self._extract_device(entities)
+            if hostname is None:
+                continue
+            alerts_by_hostname.setdefault(hostname, []).append((index, alert, entities))
+        # Alert data does not depend on the expectation, build it once per
+        # alert and only for alerts on a targeted endpoint
+        alerts_data = {}
+        # Endpoints are shared by expectations, fetch each one once per run
+        endpoints = {}
         # For each expectation, try to find the proper alert
         for expectation in expectations:
             # Check expired expectation
@@ -286,7 +274,7 @@ class OpenBASMicrosoftSentinel:
                 self.helper.api.inject_expectation.update(
                     expectation["inject_expectation_id"],
                     {
-                        "collector_id": self.config.get_conf("collector_id"),
+                        "collector_id": collector_id,
                         "result": (
                             "Not Detected"
                             if expectation["inject_expectation_type"] == "DETECTION"
@@ -296,51 +284,49 @@ class OpenBASMicrosoftSentinel:
                     },
                 )
                 continue
-            endpoint = self.helper.api.endpoint.get(
-                expectation["inject_expectation_asset"]
-            )
-            for alert in data["tables"][0]["rows"]:
-                alert_date = parse(
-                    str(alert[columns_index["TimeGenerated"]])
-                ).astimezone(pytz.UTC)
-                print(alert)
-                if alert_date > limit_date:
-                    result = self._match_alert(
-                        endpoint, columns_index, alert, expectation
+            asset_id = expectation["inject_expectation_asset"]
+            if asset_id not in endpoints:
+                endpoints[asset_id] = self.helper.api.endpoint.get(asset_id)
+            endpoint = endpoints[asset_id]
+            for index, alert, entities in alerts_by_hostname.get(
+                endpoint["endpoint_hostname"], []
+            ):
+                if index not in alerts_data:
+                    alerts_data[index] = self._build_alert_data(entities)
+                result = self._match_alert(
+                    endpoint, columns_index, alert, alerts_data[index], expectation
+                )
+                if result is not False:
+                    self.helper.collector_logger.info(
+                        "Expectation matched, fulfilling expectation "
+                        + expectation["inject_expectation_inject"]
+                        + " ("
+                        + expectation["inject_expectation_type"]
+                        + ")"
                     )
-                    if result is not False:
-                        self.helper.collector_logger.info(
-                            "Expectation matched, fulfilling expectation "
-                            + expectation["inject_expectation_inject"]
-                            + " ("
-                            + expectation["inject_expectation_type"]
-                            + ")"
+                    if expectation["inject_expectation_type"] == "DETECTION":
+                        self.helper.api.inject_expectation.update(
+                            expectation["inject_expectation_id"],
+                            {
+                                "collector_id": collector_id,
+                                "result": "Detected",
+                                "is_success": True,
+                            },
+                        )
+                        break
+                    elif (
+                        expectation["inject_expectation_type"] == "PREVENTION"
+                        and result == "PREVENTED"
+                    ):
+                        self.helper.api.inject_expectation.update(
+                            expectation["inject_expectation_id"],
+                            {
+                                "collector_id": collector_id,
+                                "result": "Prevented",
+                                "is_success": True,
+                            },
                         )
-                        if expectation["inject_expectation_type"] == "DETECTION":
-                            self.helper.api.inject_expectation.update(
-                                expectation["inject_expectation_id"],
-                                {
-                                    "collector_id": self.config.get_conf(
-                                        "collector_id"
-                                    ),
-                                    "result": "Detected",
-                                    "is_success": True,
-                                },
-                            )
-                        elif (
-                            expectation["inject_expectation_type"] == "PREVENTION"
-                            and result == "PREVENTED"
-                        ):
-                            self.helper.api.inject_expectation.update(
-                                expectation["inject_expectation_id"],
-                                {
-                                    "collector_id": self.config.get_conf(
-                                        "collector_id"
-                                    ),
-                                    "result": "Prevented",
-                                    "is_success": True,
-                                },
-                            )
+                        break
 
     def _process_message(self) -> None:
         self._process_alerts()
@@ -4,6 +4,10 @@
 
 import msal
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+LOG_ANALYTICS_URL = "https://api.loganalytics.azure.com/v1"
 
 
 class SentinelApiHandler:
@@ -21,21 +25,42 @@ class SentinelApiHandler:
         self.client_secret = client_secret
         self.helper = helper
         self.ssl_verify = ssl_verify
+        self.session = requests.Session()
+        # Retry throttled / transient failures with exponential backoff, POST
+        # is only replayed for the read-only Log Analytics queries
+        for prefix, allowed_methods in [
+            ("https://", ["GET"]),
+            (LOG_ANALYTICS_URL, ["GET", "POST"]),
+        ]:
+            self.session.mount(
+                prefix,
+                HTTPAdapter(
+                    max_retries=Retry(
+                        total=3,
+                        backoff_factor=1,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        allowed_methods=allowed_methods,
+                        raise_on_status=False,
+                    )
+                ),
+            )
+        self.app = None
         self._auth()
 
     def _auth(self):
-        # Authentication
+        # Authentication (the application is kept to reuse its token cache)
         try:
-            app = msal.ConfidentialClientApplication(
-                self.client_id,
-                authority="https://login.microsoftonline.com/" + self.tenant_id,
-                client_credential=self.client_secret,
-            )
-            result = app.acquire_token_silent(
+            if self.app is None:
+                self.app = msal.ConfidentialClientApplication(
+                    self.client_id,
+                    authority="https://login.microsoftonline.com/" + self.tenant_id,
+                    client_credential=self.client_secret,
+                )
+            result = self.app.acquire_token_silent(
                 "https://api.loganalytics.io/.default", account=None
             )
             if not result:
-                result = app.acquire_token_for_client(
+                result = self.app.acquire_token_for_client(
                     scopes=["https://api.loganalytics.io/.default"]
                 )
             self.token = result["access_token"]
@@ -68,7 +93,7 @@ class SentinelApiHandler:
                     payload["description"].replace("\n", " ").strip()
                 )
         if method == "get":
-            r = requests.get(
+            r = self.session.get(
                 url,
                 headers=headers,
                 params=payload,
@@ -76,21 +101,21 @@ class SentinelApiHandler:
             )
         elif method == "post":
             if content_type == "application/octet-stream":
-                r = requests.post(
+                r = self.session.post(
                     url,
                     headers=headers,
                     data=payload["document"],
                     verify=self.ssl_verify,
                 )
             elif type is not None:
-                r = requests.post(
+                r = self.session.post(
                     url,
                     headers=headers,
                     data=payload["intelDoc"],
                     verify=self.ssl_verify,
                 )
             else:
-                r = requests.post(
+                r = self.session.post(
                     url,
                     headers=headers,
                     json=payload,
@@ -101,7 +126,7 @@ class SentinelApiHandler:
             f.write(payload["content"])
             f.close()
             files = {"hash": open(payload["filename"], "rb")}
-            r = requests.post(
+            r = self.session.post(
                 url,
                 headers=headers,
                 files=files,
@@ -109,35 +134,35 @@ class SentinelApiHandler:
             )
         elif method == "put":
             if type is not None:
-                r = requests.put(
+                r = self.session.put(
                     url,
                     headers=headers,
                     data=payload["intelDoc"],
                     verify=self.ssl_verify,
                 )
             elif content_type == "application/xml":
-                r = requests.put(
+                r = self.session.put(
                     url,
                     headers=headers,
                     data=payload,
                     verify=self.ssl_verify,
                 )
             else:
-                r = requests.put(
+                r = self.session.put(
                     url,
                     headers=headers,
                     json=payload,
                     verify=self.ssl_verify,
                 )
         elif method == "patch":
-            r = requests.patch(
+            r = self.session.patch(
                 url,
                 headers=headers,
                 json=payload,
                 verify=self.ssl_verify,
             )
         elif method == "delete":
-            r = requests.delete(url, headers=headers, verify=self.ssl_verify)
+            r = self.session.delete(url, headers=headers, verify=self.ssl_verify)
         else:
             raise ValueError("Unsupported method")
         if r.status_code == 200:
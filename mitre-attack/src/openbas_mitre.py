@@ -73,6 +73,10 @@ class OpenBASMitre:
 
     def _attack_patterns(self, attacks, kill_chain_phases, relationships):
         attack_patterns = []
+        # Index subtechnique-of relationships by source (first one wins)
+        parents = {}
+        for relationship in relationships:
+            parents.setdefault(relationship["source_ref"], relationship["target_ref"])
         for attack in attacks:
             stix_id = attack.get("id")
             attack_pattern_name = attack.get("name")
@@ -81,7 +85,7 @@ class OpenBASMitre:
             attack_pattern_permissions_required = attack.get(
                 "x_mitre_permissions_required", []
             )
-            attack_pattern_kill_chain_phases_short_names = list(
+            attack_pattern_kill_chain_phases_short_names = set(
                 map(
                     lambda chain: chain.get("phase_name"),
                     attack.get("kill_chain_phases", []),
@@ -93,11 +97,7 @@ class OpenBASMitre:
                 if external_reference.get("source_name") == "mitre-attack":
                     attack_pattern_external_id = external_reference.get("external_id")
             # Find a possible parent in relationships
-            attack_pattern_parent = None
-            for relationship in relationships:
-                if relationship["source_ref"] == stix_id:  # subtechnique-of
-                    attack_pattern_parent = relationship["target_ref"]
-                    break
+            attack_pattern_parent = parents.get(stix_id)
             attack_pattern_kill_chain_phases_ids = [
                 x.get("phase_id")
                 for x in kill_chain_phases
@@ -1,10 +1,7 @@
 import json
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
-import pytz
 import requests
-from dateutil.parser import parse
-from dateutil.relativedelta import relativedelta
 from pyobas.helpers import (
     OpenBASCollectorHelper,
     OpenBASConfigHelper,
@@ -12,6 +9,9 @@ from pyobas.helpers import (
 )
 from tanium_api_handler import TaniumApiHandler
 
+# Alerts raised by these engines are handled by their dedicated collectors
+EXCLUDED_MATCH_TYPES = frozenset(["windows_defender", "deep_instinct"])
+
 
 class OpenBASTaniumThreatResponse:
     def __init__(self):
@@ -75,6 +75,7 @@ class OpenBASTaniumThreatResponse:
             self.config.get_conf("tanium_url"),
             self.config.get_conf("tanium_token"),
             self.config.get_conf("tanium_ssl_verify"),
+            self.session,
         )
 
         # Initialize signatures helper
@@ -90,117 +91,96 @@ class OpenBASTaniumThreatResponse:
             self.helper.collector_logger, self.relevant_signatures_types
         )
 
-    # Recursive function
+        # Parsed alert details from the previous run, by alert id and revision
+        self.parsed_details_by_alert = {}
+
+    # Walk up the process tree from the acting artifact
     def _extract_tree_names(self, artifact, names):
-        if (
-            "process" in artifact
-            and "file" in artifact["process"]
-            and "file" in artifact["process"]["file"]
-        ):
-            names.append(artifact["process"]["file"]["file"]["path"].split("\\")[-1])
-        if "process" in artifact and "parent" in artifact["process"]:
-            return self._extract_tree_names(artifact["process"]["parent"], names)
-        else:
-            return names
+        while True:
+            process = artifact.get("process")
+            if process is None:
+                return names
+            file = process.get("file")
+            if file is not None and "file" in file:
+                names.append(file["file"]["path"].rpartition("\\")[2])
+            if "parent" not in process:
+                return names
+            artifact = process["parent"]
+
+    def _extract_acting_artifacts(self, alert_details):
+        acting_artifacts = []
+        for what in alert_details.get("finding", {}).get("whats", []):
+            acting_artifact = what.get("artifact_activity", {}).get("acting_artifact")
+            if acting_artifact is not None:
+                acting_artifacts.append(acting_artifact)
+        return acting_artifacts
 
     def _extract_process_names(self, alert_details):
         process_names = []
-        if "finding" in alert_details and "whats" in alert_details["finding"]:
-            for what in alert_details["finding"]["whats"]:
-                if (
-                    "artifact_activity" in what
-                    and "acting_artifact" in what["artifact_activity"]
-                ):
-                    acting_artifact = what["artifact_activity"]["acting_artifact"]
-                    process_names = self._extract_tree_names(
-                        acting_artifact, process_names
-                    )
+        for acting_artifact in self._extract_acting_artifacts(alert_details):
+            process_names = self._extract_tree_names(acting_artifact, process_names)
         return process_names
 
-    # Recursive function
+    # Walk up the process tree from the acting artifact
     def _extract_tree_commands(self, artifact, commands):
-        if "process" in artifact and "arguments" in artifact["process"]:
-            file_path = ""
-            if "file" in artifact["process"] and "file" in artifact["process"]["file"]:
-                file_path = artifact["process"]["file"]["file"]["path"]
-            command = (
-                artifact["process"]["arguments"]
-                .replace(file_path, "")
-                .replace('""', "")
-                .strip()
-            )
-            if len(command) > 0:
-                commands.append(command)
-        if "process" in artifact and "parent" in artifact["process"]:
-            return self._extract_tree_commands(artifact["process"]["parent"], commands)
-        else:
-            return commands
+        while True:
+            process = artifact.get("process")
+            if process is None:
+                return commands
+            if "arguments" in process:
+                command = process["arguments"]
+                # Remove the executable path when the arguments repeat it
+                file = process.get("file")
+                if file is not None and "file" in file:
+                    file_path = file["file"]["path"]
+                    if file_path and file_path in command:
+                        command = command.replace(file_path, "")
+                command = command.replace('""', "").strip()
+                if len(command) > 0:
+                    commands.append(command)
+            if "parent" not in process:
+                return commands
+            artifact = process["parent"]
 
     def _extract_command_lines(self, alert_details):
         command_lines = []
-        if "finding" in alert_details and "whats" in alert_details["finding"]:
-            for what in alert_details["finding"]["whats"]:
-                if (
-                    "artifact_activity" in what
-                    and "acting_artifact" in what["artifact_activity"]
-                ):
-                    acting_artifact = what["artifact_activity"]["acting_artifact"]
-                    command_lines = self._extract_tree_commands(
-                        acting_artifact, command_lines
-                    )
+        for acting_artifact in self._extract_acting_artifacts(alert_details):
+            command_lines = self._extract_tree_commands(acting_artifact, command_lines)
         return command_lines
 
-    def _match_alert(self, endpoint, alert, expectation):
-        alert_details = json.loads(alert["details"])
+    def _build_alert_data(self, alert, alert_details):
+        # Simple signatures are searched in the whole serialized alert
+        alert_text = str(alert)
+        return {
+            "process_name": {
+                "type": "fuzzy",
+                "data": self._extract_process_names(alert_details),
+                "score": 80,
+            },
+            "command_line": {
+                "type": "fuzzy",
+                "data": self._extract_command_lines(alert_details),
+                "score": 60,
+            },
+            "file_name": {"type": "simple", "data": alert_text},
+            "hostname": {"type": "simple", "data": alert_text},
+            "ipv4_address": {"type": "simple", "data": alert_text},
+            "ipv6_address": {},
+        }
+
+    def _match_alert(self, endpoint, alert, alert_data, expectation):
+        # No asset
+        if expectation["inject_expectation_asset"] is None:
+            return False
         self.helper.collector_logger.info(
             "Trying to match alert "
             + str(alert["id"])
             + " with expectation "
             + expectation["inject_expectation_id"]
         )
-        # No asset
-        if expectation["inject_expectation_asset"] is None:
-            return False
-        # Defender / Deep Instinct (dedicated collectors)
-        if alert["matchType"] in ["windows_defender", "deep_instinct"]:
-            return False
-        # Check hostname
-        if endpoint["endpoint_hostname"] != alert["computerName"]:
-            return False
         self.helper.collector_logger.info(
             "Endpoint is matching (" + endpoint["endpoint_hostname"] + ")"
         )
-
-        alert_data = {}
-        for type in self.relevant_signatures_types:
-            alert_data[type] = {}
-            if type == "process_name":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_process_names(alert_details),
-                    "score": 80,
-                }
-            elif type == "command_line":
-                alert_data[type] = {
-                    "type": "fuzzy",
-                    "data": self._extract_command_lines(alert_details),
-                    "score": 60,
-                }
-            elif type == "file_name":
-                alert_data[type] = {
-                    "type": "simple",
-                    "data": str(alert),
-                }
-            elif type == "hostname":
-                alert_data[type] = {
-                    "type": "simple",
-                    "data": str(alert),
-                }
-            elif type == "ipv4_address":
-                alert_data[type] = {
-                    "type": "simple",
-                    "data": str(alert),
-                }
         match_result = self.openbas_detection_helper.match_alert_elements(
             signatures=expectation["inject_expectation_signatures"],
             alert_data=alert_data,
@@ -211,30 +191,55 @@ class OpenBASTaniumThreatResponse:
         return False
 
     def _process_message(self) -> None:
+        collector_id = self.config.get_conf("collector_id")
         self.helper.collector_logger.info("Gathering expectations for executed injects")
         expectations = (
             self.helper.api.inject_expectation.detection_expectations_for_source(
-                self.config.get_conf("collector_id")
+                collector_id
             )
         )
         self.helper.collector_logger.info(
             "Found " + str(len(expectations)) + " expectations waiting to be matched"
         )
+        if len(expectations) == 0:
+            return
         alerts = self.tanium_api_handler._query(
             "get",
             "/plugin/products/threat-response/api/v1/alerts",
-            {"sort": "-createdAt"},
+            {"sort": "-createdAt", "limit": 200},
         )
         self.helper.collector_logger.info(
             "Found " + str(len(alerts)) + " alerts (taking first 200)"
         )
-        limit_date = datetime.now().astimezone(pytz.UTC) - relativedelta(minutes=45)
+        limit_date = datetime.now(timezone.utc) - timedelta(minutes=45)
+        # Index alerts by computer so each endpoint only sees its own
+        alerts_by_hostname = {}
+        for alert in alerts[:200]:
+            # Alerts are sorted by creation date, the rest are older
+            if (
+                datetime.fromisoformat(alert["createdAt"]).astimezone(timezone.utc)
+                <= limit_date
+            ):
+                break
+            # Defender / Deep Instinct (dedicated collectors)
+            if (
+                alert["state"] != "suppressed"
+                and alert["matchType"] not in EXCLUDED_MATCH_TYPES
+            ):
+                alerts_by_hostname.setdefault(alert["computerName"], []).append(alert)
+        # Alert data does not depend on the expectation, build it once per
+        # alert and only for alerts on a targeted endpoint. Parsed details are
+        # kept for the next run, where most alerts show up again
+        alerts_data = {}
+        parsed_details = {}
+        # Endpoints are shared by expectations, fetch each one once per run
+        endpoints = {}
         # For each expectation, try to find the proper alert
         for expectation in expectations:
             # Check expired expectation
-            expectation_date = parse(
+            expectation_date = datetime.fromisoformat(
                 expectation["inject_expectation_created_at"]
-            ).astimezone(pytz.UTC)
+            ).astimezone(timezone.utc)
             if expectation_date < limit_date:
                 self.helper.collector_logger.info(
                     "Expectation expired, failing inject "
@@ -246,34 +251,47 @@ class OpenBASTaniumThreatResponse:
                 self.helper.api.inject_expectation.update(
                     expectation["inject_expectation_id"],
                     {
-                        "collector_id": self.config.get_conf("collector_id"),
+                        "collector_id": collector_id,
                         "result": "Not Detected",
                         "is_success": False,
                     },
                 )
                 continue
-            endpoint = self.helper.api.endpoint.get(
-                expectation["inject_expectation_asset"]
-            )
-            for alert in alerts[:200]:
-                alert_date = parse(alert["createdAt"]).astimezone(pytz.UTC)
-                if alert_date > limit_date and alert["state"] != "suppressed":
-                    if self._match_alert(endpoint, alert, expectation):
-                        self.helper.collector_logger.info(
-                            "Expectation matched, fulfilling expectation "
-                            + expectation["inject_expectation_inject"]
-                            + " ("
-                            + expectation["inject_expectation_type"]
-                            + ")"
-                        )
-                        self.helper.api.inject_expectation.update(
-                            expectation["inject_expectation_id"],
-                            {
-                                "collector_id": self.config.get_conf("collector_id"),
-                                "result": "Detected",
-                                "is_success": True,
-                            },
-                        )
+            asset_id = expectation["inject_expectation_asset"]
+            if asset_id not in endpoints:
+                endpoints[asset_id] = self.helper.api.endpoint.get(asset_id)
+            endpoint = endpoints[asset_id]
+            for alert in alerts_by_hostname.get(endpoint["endpoint_hostname"], []):
+                if alert["id"] not in alerts_data:
+                    # Details can be enriched later, so the revision is part of the key
+                    alert_key = (alert["id"], alert.get("updatedAt"))
+                    alert_details = self.parsed_details_by_alert.get(alert_key)
+                    if alert_details is None:
+                        alert_details = json.loads(alert["details"])
+                    parsed_details[alert_key] = alert_details
+                    alerts_data[alert["id"]] = self._build_alert_data(
+                        alert, alert_details
+                    )
+                if self._match_alert(
+                    endpoint, alert, alerts_data[alert["id"]], expectation
+                ):
+                    self.helper.collector_logger.info(
+                        "Expectation matched, fulfilling expectation "
+                        + expectation["inject_expectation_inject"]
+                        + " ("
+                        + expectation["inject_expectation_type"]
+                        + ")"
+                    )
+                    self.helper.api.inject_expectation.update(
+                        expectation["inject_expectation_id"],
+                        {
+                            "collector_id": collector_id,
+                            "result": "Detected",
+                            "is_success": True,
+                        },
+                    )
+                    break
+        self.parsed_details_by_alert = parsed_details
 
     # Start the main loop
     def start(self):
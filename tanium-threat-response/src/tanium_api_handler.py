@@ -2,7 +2,12 @@
 # TANIUM API HANDLER #
 ######################
 
+import io
+import os
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 class TaniumApiHandler:
@@ -12,12 +17,27 @@ class TaniumApiHandler:
         url,
         token,
         ssl_verify=True,
+        session=None,
     ):
         # Variables
         self.helper = helper
         self.url = url
         self.token = token
         self.ssl_verify = ssl_verify
+        self.session = session if session is not None else requests.Session()
+        # Retry throttled / transient failures with exponential backoff
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=1,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=["GET"],
+                    raise_on_status=False,
+                )
+            ),
+        )
 
     def get_url(self):
         return self.url
@@ -46,83 +66,40 @@ class TaniumApiHandler:
                 headers["description"] = (
                     payload["description"].replace("\n", " ").strip()
                 )
+        # Shape the request body, the verb itself is dispatched by the session
+        kwargs = {}
         if method == "get":
-            r = requests.get(
-                self.url + uri,
-                headers=headers,
-                params=payload,
-                verify=self.ssl_verify,
-            )
-        elif method == "post":
-            if content_type == "application/octet-stream":
-                r = requests.post(
-                    self.url + uri,
-                    headers=headers,
-                    data=payload["document"],
-                    verify=self.ssl_verify,
-                )
-            elif type is not None:
-                r = requests.post(
-                    self.url + uri,
-                    headers=headers,
-                    data=payload["intelDoc"],
-                    verify=self.ssl_verify,
-                )
+            kwargs["params"] = payload
+        elif method in ["post", "put", "patch"]:
+            if method == "post" and content_type == "application/octet-stream":
+                kwargs["data"] = payload["document"]
+            elif method != "patch" and type is not None:
+                kwargs["data"] = payload["intelDoc"]
+            elif method == "put" and content_type == "application/xml":
+                kwargs["data"] = payload
             else:
-                r = requests.post(
-                    self.url + uri,
-                    headers=headers,
-                    json=payload,
-                    verify=self.ssl_verify,
-                )
+                kwargs["json"] = payload
         elif method == "upload":
-            f = open(payload["filename"], "w")
-            f.write(payload["content"])
-            f.close()
-            files = {"hash": open(payload["filename"], "rb")}
-            r = requests.post(
-                self.url + uri,
-                headers=headers,
-                files=files,
-                verify=self.ssl_verify,
-            )
-        elif method == "put":
-            if type is not None:
-                r = requests.put(
-                    self.url + uri,
-                    headers=headers,
-                    data=payload["intelDoc"],
-                    verify=self.ssl_verify,
-                )
-            elif content_type == "application/xml":
-                r = requests.put(
-                    self.url + uri,
-                    headers=headers,
-                    data=payload,
-                    verify=self.ssl_verify,
-                )
-            else:
-                r = requests.put(
-                    self.url + uri,
-                    headers=headers,
-                    json=payload,
-                    verify=self.ssl_verify,
+            # Send the content from memory instead of a temporary file
+            kwargs["files"] = {
+                "hash": (
+                    os.path.basename(payload["filename"]),
+                    io.BytesIO(payload["content"].encode("utf-8")),
                 )
-        elif method == "patch":
-            r = requests.patch(
-                self.url + uri,
-                headers=headers,
-                json=payload,
-                verify=self.ssl_verify,
-            )
-        elif method == "delete":
-            r = requests.delete(self.url + uri, headers=headers, verify=self.ssl_verify)
-        else:
+            }
+        elif method != "delete":
             raise ValueError("Unsupported method")
-        if r.status_code == 200:
+        r = self.session.request(
+            "post" if method == "upload" else method,
+            self.url + uri,
+            headers=headers,
+            verify=self.ssl_verify,
+            **kwargs,
+        )
+        if r.ok:
             try:
                 return r.json()["data"]
-            except:
+            except (ValueError, KeyError, TypeError):
                 return r.text
         elif r.status_code == 401:
             raise ValueError("Query failed, permission denied")